@@ -1,13 +1,24 @@
 import os
+import atexit
+import asyncio
 import logging
-import time  # Adicionei esta linha
+import queue
+from logging.handlers import QueueHandler, QueueListener
 from telegram import Bot, Update, InlineKeyboardButton, InlineKeyboardMarkup
-from telegram.ext import Updater, CommandHandler, MessageHandler, Filters, CallbackContext
+from telegram.error import BadRequest, ChatMigrated, Forbidden, NetworkError, RetryAfter
+from telegram.ext import AIORateLimiter, Application, CommandHandler, ChatMemberHandler, MessageHandler, ContextTypes, filters
 
 # Configuração básica
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
 CHANNEL_ID = os.getenv('SOURCE_CHANNEL_ID')  # ID do canal de origem (com @ ou numérico)
 ADMIN_ID = os.getenv('ADMIN_USER_ID')  # Seu ID de usuário para comandos admin
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')  # URL pública do bot; se vazia, usa polling
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')  # Conferido no header X-Telegram-Bot-Api-Secret-Token
+PORT = int(os.getenv('PORT', '8443'))
+ENV = os.getenv('ENV')  # 'production' exige webhook
+
+# Tipos de update que o bot realmente usa
+ALLOWED_UPDATES = ['message', 'channel_post', 'my_chat_member']
 
 # Configurar logging
 logging.basicConfig(
@@ -16,124 +27,195 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Tira a escrita dos logs do caminho dos handlers: eles formatam e enfileiram o
+# registro, e uma thread de fundo (o listener) faz a escrita no stderr
+_log_queue = queue.SimpleQueue()
+_root_logger = logging.getLogger()
+log_listener = QueueListener(_log_queue, *_root_logger.handlers, respect_handler_level=True)
+_root_logger.handlers = [QueueHandler(_log_queue)]
+log_listener.start()
+# Esvazia a fila de logs ao sair, inclusive quando a inicialização falha
+atexit.register(log_listener.stop)
+
+# Tipos de chat e status consultados a cada update (frozenset: uma busca por hash)
+_GROUP_TYPES = frozenset({'group', 'supergroup'})
+_LEFT_STATUSES = frozenset({'left', 'kicked'})
+
+# Trechos de erros BadRequest que indicam que o grupo não existe mais para o bot;
+# os demais (legenda longa, entidades inválidas...) são problema da publicação
+_DEAD_CHAT_ERRORS = ('chat not found', 'group chat was deactivated', 'peer_id_invalid')
+
 # Dicionário para armazenar temporariamente os grupos (simulando DB)
 groups_cache = {
-    'group_ids': set(),
-    'last_update': 0
+    'group_ids': set()
+}
+
+# Publicações do canal são encaminhadas uma de cada vez, na ordem de chegada
+# (os updates são tratados em paralelo, e itens de álbum chegam juntos)
+_forward_lock = asyncio.Lock()
+
+# Teclado com o botão do canal, montado uma única vez (o canal não muda)
+channel_markup_cache = {
+    'markup': None
 }
 
-def start(update: Update, context: CallbackContext) -> None:
+async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     """Envia mensagem de boas-vindas quando o comando /start é recebido."""
-    update.message.reply_text('🤖 Bot de encaminhamento ativo! Adicione-me a grupos como admin para funcionar.')
+    await update.message.reply_text('🤖 Bot de encaminhamento ativo! Adicione-me a grupos como admin para funcionar.')
 
-def update_groups_list(context: CallbackContext) -> None:
-    """Atualiza a lista de grupos onde o bot está presente."""
-    bot = context.bot
+async def get_channel_markup(bot: Bot) -> InlineKeyboardMarkup:
+    """Retorna o teclado com o botão do canal, criando-o na primeira chamada."""
+    if channel_markup_cache['markup'] is None:
+        channel = await bot.get_chat(CHANNEL_ID)
+        keyboard = [[InlineKeyboardButton(f"📢 {channel.title}", url=f"https://t.me/{channel.username}")]]
+        channel_markup_cache['markup'] = InlineKeyboardMarkup(keyboard)
+    return channel_markup_cache['markup']
+
+async def track_chat_member(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Atualiza a lista de grupos quando o próprio bot entra ou sai de um grupo."""
+    member = update.my_chat_member.new_chat_member
+    chat = update.my_chat_member.chat
+    if chat.type in _GROUP_TYPES:
+        if member.status in _LEFT_STATUSES:
+            groups_cache['group_ids'].discard(chat.id)
+        else:
+            groups_cache['group_ids'].add(chat.id)
+
+async def track_group(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Registra na lista o grupo de onde veio a mensagem."""
+    groups_cache['group_ids'].add(update.effective_chat.id)
+
+async def forward_to_group(bot: Bot, group_id: int, message, reply_markup: InlineKeyboardMarkup) -> None:
+    """Envia uma mensagem do canal para um grupo."""
     try:
-        # Obtém todas as conversas onde o bot está presente
-        updates = bot.get_updates()
-        
-        group_ids = set()
-        for update in updates:
-            if update.message and update.message.chat.type in ['group', 'supergroup']:
-                group_ids.add(update.message.chat.id)
-            elif update.channel_post and update.channel_post.chat.type == 'channel':
-                # Para canais, verificar se o bot é admin
-                chat_member = bot.get_chat_member(update.channel_post.chat.id, bot.id)
-                if chat_member.status in ['administrator', 'creator']:
-                    group_ids.add(update.channel_post.chat.id)
-        
-        # Adiciona também os grupos obtidos via getUpdates
-        for chat in bot.get_updates(limit=100):
-            if chat.message and chat.message.chat.type in ['group', 'supergroup']:
-                group_ids.add(chat.message.chat.id)
-        
-        groups_cache['group_ids'] = group_ids
-        groups_cache['last_update'] = time.time()
-        logger.info(f"Lista de grupos atualizada. Total: {len(group_ids)}")
+        if message.text:
+            await bot.send_message(
+                chat_id=group_id,
+                text=message.text,
+                reply_markup=reply_markup
+            )
+        elif message.photo:
+            await bot.send_photo(
+                chat_id=group_id,
+                photo=message.photo[-1].file_id,
+                caption=message.caption,
+                reply_markup=reply_markup
+            )
+        elif message.video:
+            await bot.send_video(
+                chat_id=group_id,
+                video=message.video.file_id,
+                caption=message.caption,
+                reply_markup=reply_markup
+            )
+        elif message.document:
+            await bot.send_document(
+                chat_id=group_id,
+                document=message.document.file_id,
+                caption=message.caption,
+                reply_markup=reply_markup
+            )
+        logger.info(f"Mensagem {message.message_id} encaminhada para o grupo {group_id}")
+    except RetryAfter as e:
+        # Limite de envio do Telegram mesmo após as novas tentativas do rate
+        # limiter: o grupo continua válido, só não insiste agora
+        logger.warning(f"Limite de envio atingido no grupo {group_id}; aguarde {e.retry_after}s")
+    except ChatMigrated as e:
+        # Grupo virou supergrupo: troca o ID na lista e reenvia para o novo
+        logger.info(f"Grupo {group_id} migrou para {e.new_chat_id}")
+        groups_cache['group_ids'].discard(group_id)
+        groups_cache['group_ids'].add(e.new_chat_id)
+        await forward_to_group(bot, e.new_chat_id, message, reply_markup)
+    except Forbidden as e:
+        # Bot removido ou bloqueado: tira o grupo da lista
+        logger.error(f"Erro ao encaminhar para grupo {group_id}: {e}")
+        groups_cache['group_ids'].discard(group_id)
+    except BadRequest as e:
+        logger.error(f"Erro ao encaminhar para grupo {group_id}: {e}")
+        # Só tira o grupo da lista se o erro for do chat, não da publicação
+        if any(text in e.message.lower() for text in _DEAD_CHAT_ERRORS):
+            groups_cache['group_ids'].discard(group_id)
+    except NetworkError as e:
+        # Falha passageira de rede (inclui TimedOut): o grupo continua na lista
+        logger.warning(f"Falha de rede ao encaminhar para grupo {group_id}: {e}")
     except Exception as e:
-        logger.error(f"Erro ao atualizar lista de grupos: {e}")
+        logger.error(f"Erro ao encaminhar para grupo {group_id}: {e}")
 
-def forward_from_channel(context: CallbackContext) -> None:
-    """Verifica mensagens do canal e encaminha para os grupos."""
+async def forward_from_channel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Encaminha cada nova publicação do canal para os grupos."""
     bot = context.bot
+    message = update.channel_post
     
     try:
-        # Atualiza a lista de grupos periodicamente
-        if time.time() - groups_cache['last_update'] > 3600:  # 1 hora
-            update_groups_list(context)
-        
-        # Obtém as últimas mensagens do canal
-        messages = bot.get_chat_history(CHANNEL_ID, limit=1)
-        
-        for message in messages:
-            # Verifica se a mensagem já foi processada (simples mecanismo de cache)
-            if hasattr(message, 'message_id') and not getattr(message, 'is_forwarded', False):
-                # Cria botão com o nome do canal
-                channel = bot.get_chat(CHANNEL_ID)
-                keyboard = [[InlineKeyboardButton(f"📢 {channel.title}", url=f"https://t.me/{channel.username}")]]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                # Encaminha para todos os grupos
-                for group_id in groups_cache['group_ids']:
-                    try:
-                        if message.text:
-                            bot.send_message(
-                                chat_id=group_id,
-                                text=message.text,
-                                reply_markup=reply_markup
-                            )
-                        elif message.photo:
-                            bot.send_photo(
-                                chat_id=group_id,
-                                photo=message.photo[-1].file_id,
-                                caption=message.caption,
-                                reply_markup=reply_markup
-                            )
-                        elif message.video:
-                            bot.send_video(
-                                chat_id=group_id,
-                                video=message.video.file_id,
-                                caption=message.caption,
-                                reply_markup=reply_markup
-                            )
-                        elif message.document:
-                            bot.send_document(
-                                chat_id=group_id,
-                                document=message.document.file_id,
-                                caption=message.caption,
-                                reply_markup=reply_markup
-                            )
-                        # Marca como encaminhada
-                        message.is_forwarded = True
-                        logger.info(f"Mensagem {message.message_id} encaminhada para o grupo {group_id}")
-                    except Exception as e:
-                        logger.error(f"Erro ao encaminhar para grupo {group_id}: {e}")
-                        # Remove grupo da lista se houver erro (pode ter sido removido)
-                        groups_cache['group_ids'].discard(group_id)
+        async with _forward_lock:
+            # Botão com o nome do canal (construído uma vez e reutilizado)
+            reply_markup = await get_channel_markup(bot)
+            
+            # Encaminha para todos os grupos ao mesmo tempo
+            await asyncio.gather(*(
+                forward_to_group(bot, group_id, message, reply_markup)
+                for group_id in tuple(groups_cache['group_ids'])
+            ))
     except Exception as e:
         logger.error(f"Erro no forward_from_channel: {e}")
 
 def main() -> None:
     """Inicia o bot."""
-    # Cria o Updater e passa o token do bot
-    updater = Updater(TOKEN)
+    # Em produção o bot só roda via webhook; polling fica restrito ao desenvolvimento
+    if ENV == 'production' and not WEBHOOK_URL:
+        raise RuntimeError("WEBHOOK_URL é obrigatória quando ENV=production")
+    if ENV == 'production' and not WEBHOOK_SECRET:
+        raise RuntimeError("WEBHOOK_SECRET é obrigatório quando ENV=production")
 
-    # Obtém o dispatcher para registrar handlers
-    dispatcher = updater.dispatcher
+    # Cria a Application com o token do bot; até 16 updates são tratados ao
+    # mesmo tempo, para que uma chamada lenta à API não segure as demais.
+    # O rate limiter segura os envios dentro dos limites do Telegram
+    # (30 msg/s no total e 20 msg/min por grupo) durante o encaminhamento e,
+    # se mesmo assim vier um RetryAfter, espera o tempo pedido e tenta de novo
+    application = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(16)
+        .rate_limiter(AIORateLimiter(max_retries=3))
+        .build()
+    )
 
     # Comandos
-    dispatcher.add_handler(CommandHandler("start", start))
+    application.add_handler(CommandHandler("start", start))
+
+    # Todo grupo que manda mensagem entra na lista (grupo -1: roda antes dos
+    # demais handlers sem impedir que eles também tratem o update)
+    application.add_handler(MessageHandler(filters.ChatType.GROUPS, track_group), group=-1)
 
-    # Inicia o job para encaminhar mensagens periodicamente
-    job_queue = updater.job_queue
-    job_queue.run_repeating(forward_from_channel, interval=300.0, first=10.0)  # Verifica a cada 5 minutos
+    # Mantém a lista de grupos em dia com as entradas e saídas do próprio bot
+    application.add_handler(ChatMemberHandler(track_chat_member, ChatMemberHandler.MY_CHAT_MEMBER))
 
-    # Inicia o Bot
-    updater.start_polling()
+    # Publicações do canal de origem (aceita @username ou ID numérico) chegam
+    # como channel_post e são encaminhadas assim que recebidas
+    if CHANNEL_ID and CHANNEL_ID.lstrip('-').isdigit():
+        source_channel = filters.Chat(chat_id=int(CHANNEL_ID))
+    else:
+        source_channel = filters.Chat(username=CHANNEL_ID)
+    application.add_handler(MessageHandler(filters.UpdateType.CHANNEL_POST & source_channel, forward_from_channel))
 
-    # Roda o bot até que Ctrl-C seja pressionado
-    updater.idle()
+    # Roda o bot até que Ctrl-C seja pressionado: webhook quando houver URL
+    # configurada, polling caso contrário
+    if WEBHOOK_URL:
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=PORT,
+            url_path=TOKEN,
+            webhook_url=f"{WEBHOOK_URL}/{TOKEN}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=ALLOWED_UPDATES,
+            max_connections=40
+        )
+    else:
+        # Long polling de 50s: o Telegram segura a conexão até chegar um update
+        application.run_polling(
+            timeout=50,
+            allowed_updates=ALLOWED_UPDATES
+        )
 
 if __name__ == '__main__':
     main()
\ No newline at end of file